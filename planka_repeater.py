@@ -26,21 +26,33 @@ Configuration (fichier .env à la racine) :
     TODO_LIST_NAME=To Do
     DONE_LIST_NAME=Done
     POLL_SECONDS=10
+    POLL_SECONDS_MAX=130     # optionnel: plafond du backoff quand rien ne bouge
+    WEBHOOK_PORT=8321        # optionnel: active l'écoute des webhooks Planka
 
 Dépendances :
     pip install -r requirements.txt
       -> requests
       -> python-dateutil
       -> python-dotenv
+      -> orjson
 """
+import json
 import os
+import queue
 import re
+import threading
 import time
 import logging
-from datetime import datetime, timezone
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from typing import Dict, Optional, Tuple
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dateutil import parser as dtparse
 from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
@@ -56,7 +68,10 @@ logging.basicConfig(
 )
 
 # --- Regex pour la récurrence : [R-<n><U>] où n optionnel, U ∈ {D, W, M} ------
-REPEAT_REGEX = re.compile(r"\[(R-(?:(\d+)?\s*(D|W|M)))\]", re.IGNORECASE)
+REPEAT_REGEX = re.compile(r"\[R-(\d+)?([DWM])\]", re.IGNORECASE)
+
+# Taille max des caches par carte (LRU): borne la mémoire d'un daemon longue durée
+MAX_TRACKED_CARDS = 10_000
 
 
 # --- Helpers -----------------------------------------------------------------
@@ -66,22 +81,42 @@ def _to_planka_iso(dt: datetime) -> str:
         dt = dt.replace(tzinfo=timezone.utc)
     else:
         dt = dt.astimezone(timezone.utc)
-    return dt.replace(microsecond=0).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    # f-string direct: évite le parsing du format et la machinerie locale de strftime
+    return (
+        f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+        f"T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}.000Z"
+    )
 
 
 def _parse_iso_safe(s: Optional[str]) -> Optional[datetime]:
-    """Parse ISO → datetime (timezone-aware UTC). Retourne None si invalide/absent."""
+    """Parse ISO → datetime (timezone-aware UTC). Retourne None si invalide/absent.
+
+    Planka émet toujours YYYY-MM-DDTHH:MM:SS.sssZ: `datetime.fromisoformat`
+    (C, ~2 ordres de grandeur plus rapide que dateutil) couvre ce cas;
+    dateutil ne sert plus que de filet pour les formats exotiques.
+    """
     if not s:
         return None
     try:
-        dt = dtparse.parse(s)
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        else:
-            dt = dt.astimezone(timezone.utc)
-        return dt
-    except Exception:
-        return None
+        dt = datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s)
+    except ValueError:
+        try:
+            dt = dtparse.parse(s)
+        except Exception:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    else:
+        dt = dt.astimezone(timezone.utc)
+    return dt
+
+
+def _remember(state: OrderedDict, key: str, value) -> None:
+    """Insertion LRU: rafraîchit la position et évince les plus anciens au-delà du cap."""
+    state[key] = value
+    state.move_to_end(key)
+    while len(state) > MAX_TRACKED_CARDS:
+        state.popitem(last=False)
 
 
 # --- Client Planka ------------------------------------------------------------
@@ -91,7 +126,25 @@ class PlankaClient:
         self.username = username
         self.password = password
         self.session = requests.Session()
+        # Keep-alive + pool explicite + retries 5xx: pas de renégociation TLS
+        # à chaque erreur transitoire, pas de boucle de retry à écrire ici
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=Retry(
+                total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Connection"] = "keep-alive"
         self.token: Optional[str] = None
+        # Cache ETag par board: évite de re-télécharger/re-parser un board inchangé
+        self._board_etags: Dict[str, str] = {}
+        self._board_cache: Dict[str, dict] = {}
+        # Cache (todo_id, done_id): les IDs de listes ne bougent quasiment jamais
+        self._list_ids: Optional[Tuple[str, str]] = None
+        self._list_ids_key: Optional[Tuple[str, str]] = None
 
     # Extraction robuste du token quel que soit le format de réponse
     def _extract_token(self, payload) -> Optional[str]:
@@ -154,27 +207,124 @@ class PlankaClient:
 
     def get_board(self, board_id: str) -> dict:
         url = f"{self.base_url}/api/boards/{board_id}"
-        resp = self.session.get(url, timeout=30)
+        headers = {}
+        etag = self._board_etags.get(board_id)
+        if etag and board_id in self._board_cache:
+            headers["If-None-Match"] = etag
+        resp = self.session.get(url, headers=headers, timeout=30)
+        if resp.status_code == 304:
+            # Rien n'a changé côté serveur -> on resert le board déjà parsé
+            return self._board_cache[board_id]
         resp.raise_for_status()
-        return resp.json()
+        # orjson: bytes -> dict direct, nettement plus rapide que resp.json()
+        # sur les gros payloads de board
+        board = orjson.loads(resp.content)
+        new_etag = resp.headers.get("ETag")
+        if new_etag:
+            self._board_etags[board_id] = new_etag
+            self._board_cache[board_id] = board
+        return board
+
+    def resolve_list_ids(self, board: dict, todo_name: str, done_name: str) -> Tuple[str, str]:
+        """Retourne (todo_id, done_id) pour les noms de listes donnés.
+
+        Mémoïsé sur le client, mais revalidé à chaque appel: une simple passe
+        sur les listes du board vérifie que les IDs cachés portent toujours
+        les bons noms (liste supprimée/recréée ou renommée -> re-scan).
+        """
+        key = (todo_name, done_name)
+        if self._list_ids is not None and self._list_ids_key == key:
+            cached_todo, cached_done = self._list_ids
+            todo_ok = done_ok = False
+            for lst in board.get("included", {}).get("lists", []):
+                lid = str(lst.get("id"))
+                if lid == cached_todo and lst.get("name") == todo_name:
+                    todo_ok = True
+                elif lid == cached_done and lst.get("name") == done_name:
+                    done_ok = True
+            if todo_ok and done_ok:
+                return self._list_ids
+            logging.warning("⚠️ Listes TODO/DONE modifiées sur le board, re-scan")
+            self.invalidate_list_ids()
+
+        todo_id: Optional[str] = None
+        done_id: Optional[str] = None
+        for lst in board.get("included", {}).get("lists", []):
+            name = lst.get("name")
+            if name == todo_name:
+                todo_id = str(lst["id"])
+            elif name == done_name:
+                done_id = str(lst["id"])
+        if not todo_id or not done_id:
+            raise RuntimeError("Impossible de trouver les listes TODO/DONE")
+
+        self._list_ids = (todo_id, done_id)
+        self._list_ids_key = key
+        return self._list_ids
+
+    def invalidate_list_ids(self) -> None:
+        """À appeler si une liste a été renommée/supprimée (force un re-scan)."""
+        self._list_ids = None
+        self._list_ids_key = None
+
+    def stream_webhooks(self, port: int) -> "queue.Queue[str]":
+        """Démarre un mini serveur HTTP (thread daemon) recevant les webhooks Planka.
+
+        Les POST reçus (cardUpdate, cardMove, ...) poussent l'ID de carte
+        concernée dans la queue retournée; run_loop s'en sert pour se
+        réveiller dès qu'un changement arrive au lieu d'attendre le poll.
+        """
+        events: "queue.Queue[str]" = queue.Queue()
+
+        class _WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):  # noqa: N802 (API http.server)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                try:
+                    payload = json.loads(body)
+                    item = (payload.get("data") or {}).get("item") or {}
+                    card_id = str(item.get("id") or "")
+                except (ValueError, AttributeError):
+                    card_id = ""
+                events.put(card_id)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, fmt, *args):
+                logging.debug("webhook: " + fmt, *args)
+
+        server = HTTPServer(("0.0.0.0", port), _WebhookHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        logging.info("📡 Webhooks Planka écoutés sur le port %s", port)
+        return events
 
     def patch_card(self, card_id: str, payload: dict) -> dict:
         url = f"{self.base_url}/api/cards/{card_id}"
         resp = self.session.patch(url, json=payload, timeout=30)
         resp.raise_for_status()
-        return resp.json()
+        return orjson.loads(resp.content)
 
 
 # --- Utilitaires de récurrence -----------------------------------------------
-def parse_repeat_rule(text: str) -> Optional[Tuple[int, str]]:
-    """Retourne (count, unit) pour le premier tag [R-nX] trouvé (X ∈ {D,W,M})."""
-    if not text:
-        return None
-    m = REPEAT_REGEX.search(text)
+def parse_repeat_rule(title: str, desc: str = "") -> Optional[Tuple[int, str]]:
+    """Retourne (count, unit) pour le premier tag [R-nX] trouvé (X ∈ {D,W,M}).
+
+    Cherche d'abord dans le titre (cas le plus courant) et ne regarde la
+    description que si le titre ne contient pas de tag — évite de concaténer
+    et de re-scanner les deux textes à chaque carte. Un test de sous-chaîne
+    "[r-" (bien moins cher que la regex) écarte d'emblée la grande majorité
+    des cartes sans tag.
+    """
+    m = None
+    if title and "[r-" in title.lower():
+        m = REPEAT_REGEX.search(title)
+    if not m and desc and "[r-" in desc.lower():
+        m = REPEAT_REGEX.search(desc)
     if not m:
         return None
-    count = int(m.group(2)) if m.group(2) else 1
-    unit = m.group(3).upper()
+    count = int(m.group(1)) if m.group(1) else 1
+    unit = m.group(2).upper()
     return count, unit
 
 
@@ -185,10 +335,12 @@ def add_period(base: datetime, count: int, unit: str) -> datetime:
     else:
         base = base.astimezone(timezone.utc)
     unit = unit.upper()
+    # timedelta (implémenté en C) suffit pour jours/semaines;
+    # relativedelta reste nécessaire pour le calcul calendaire des mois
     if unit == "D":
-        return base + relativedelta(days=+count)
+        return base + timedelta(days=count)
     if unit == "W":
-        return base + relativedelta(weeks=+count)
+        return base + timedelta(weeks=count)
     if unit == "M":
         return base + relativedelta(months=+count)
     return base
@@ -203,6 +355,8 @@ def run_loop():
     todo_list_name = os.getenv("TODO_LIST_NAME", "To Do")
     done_list_name = os.getenv("DONE_LIST_NAME", "Done")
     poll_seconds = int(os.getenv("POLL_SECONDS", "10"))
+    poll_seconds_max = int(os.getenv("POLL_SECONDS_MAX", "130"))
+    webhook_port = os.getenv("WEBHOOK_PORT")
 
     missing = [
         k
@@ -220,98 +374,197 @@ def run_loop():
     client = PlankaClient(base_url, username, password)
     client.login()
 
+    # Webhooks optionnels: réveil immédiat sur changement, sinon simple poll
+    events = client.stream_webhooks(int(webhook_port)) if webhook_port else None
+
     # Mémoire process: évite doublons tant que l'état (listId+dueDate) ne change pas
-    processed_in_this_state: Dict[str, str] = {}
+    # (LRU borné: les cartes supprimées/renommées ne font pas fuir la mémoire)
+    processed_in_this_state: "OrderedDict[str, Tuple[str, Optional[str]]]" = OrderedDict()
+
+    # Signature par carte (listId, dueDate, updatedAt): les cartes inchangées
+    # sautent tout le pipeline (regex, parse ISO, ...) au tick suivant
+    card_sigs: "OrderedDict[str, int]" = OrderedDict()
+
+    # Backoff progressif quand rien ne bouge (remis à zéro au moindre patch)
+    idle_ticks = 0
 
     while True:
+        sleep_for = float(poll_seconds)
         try:
             board = client.get_board(board_id)
             included = board.get("included", {})
-            lists = {str(lst["id"]): lst for lst in included.get("lists", [])}
             cards = included.get("cards", [])
 
-            # IDs des listes
-            todo_id = next(
-                (lid for lid, l in lists.items() if l.get("name") == todo_list_name),
-                None,
-            )
-            done_id = next(
-                (lid for lid, l in lists.items() if l.get("name") == done_list_name),
-                None,
+            # IDs des listes (mémoïsés; resolve_list_ids revalide et re-scanne
+            # tout seul si les listes ont changé — une RuntimeError signifie
+            # qu'elles sont introuvables et part dans le handler générique)
+            todo_id, done_id = client.resolve_list_ids(
+                board, todo_list_name, done_list_name
             )
-            if not todo_id or not done_id:
-                raise RuntimeError("Impossible de trouver les listes TODO/DONE")
 
-            # Position de fin de To Do (empiler en bas)
-            todo_positions = [
-                c.get("position", 0) for c in cards if str(c.get("listId")) == str(todo_id)
-            ]
-            end_position = (max(todo_positions) + 1) if todo_positions else 1
+            # Position de fin de To Do (empiler en bas) — générateur: pas de
+            # liste intermédiaire juste pour prendre un max
+            end_position = max(
+                (c.get("position", 0) for c in cards if str(c.get("listId")) == todo_id),
+                default=0,
+            ) + 1
 
             now_utc = datetime.now(timezone.utc)
 
+            # Prochaine échéance connue (pour se réveiller pile au bon moment)
+            next_wake: Optional[datetime] = None
+            patched = False
+
+            # PATCHes à émettre pour ce tick: collectés pendant la passe puis
+            # envoyés en parallèle (K cartes échues -> ~1 RTT au lieu de K)
+            pending_patches = []
+
             for card in cards:
                 cid = str(card.get("id"))
+
+                # Carte identique au tick précédent -> rien à refaire.
+                # (La signature n'est PAS enregistrée pour les cartes en
+                # attente d'échéance, qui doivent être réexaminées.)
+                sig = hash((card.get("listId"), card.get("dueDate"), card.get("updatedAt")))
+                if card_sigs.get(cid) == sig:
+                    continue
+
                 list_id = str(card.get("listId"))
                 title = card.get("name") or ""
                 desc = (card.get("description") or "")
-                rep = parse_repeat_rule(title + "\n" + desc)
+                rep = parse_repeat_rule(title, desc)
 
                 if not rep:
+                    _remember(card_sigs, cid, sig)
                     continue  # pas de tag de récurrence -> on ignore
 
                 # On ne gère la minuterie QUE quand la carte est en DONE
-                if list_id != str(done_id):
+                # (done_id est déjà une str via resolve_list_ids)
+                if list_id != done_id:
+                    _remember(card_sigs, cid, sig)
                     continue
 
                 count, unit = rep
                 due_raw = card.get("dueDate")
                 due_dt = _parse_iso_safe(due_raw)
 
-                state_key = f"{cid}:{list_id}:{due_raw}"
+                # Tuple plutôt que f-string: pas d'allocation de chaîne sur le
+                # chemin no-op (la comparaison de tuples réutilise les strings
+                # du payload JSON)
+                state_key = (list_id, due_raw)
                 if processed_in_this_state.get(cid) == state_key:
                     continue  # pas de changement d'état depuis le dernier poll
 
-                # 1) Si pas de dueDate ou dueDate déjà passée/égale -> on programme le retour
-                if (due_dt is None) or (due_dt <= now_utc):
+                # 1) Pas de dueDate -> on programme le retour
+                if due_dt is None:
                     new_due = add_period(now_utc, count, unit)
                     payload = {"dueDate": _to_planka_iso(new_due)}
-                    client.patch_card(cid, payload)
-                    logging.info(
-                        "⏱️ Programmation retour (%s, R-%s%s) | dueDate=%s",
-                        cid, count, unit, payload["dueDate"]
-                    )
-                    # mémoriser l'état (va inclure la nouvelle dueDate au prochain tour)
-                    processed_in_this_state[cid] = state_key
+                    pending_patches.append({
+                        "cid": cid,
+                        "payload": payload,
+                        "state_key": state_key,
+                        "sig": sig,
+                        "log": (
+                            "⏱️ Programmation retour (%s, R-%s%s) | dueDate=%s",
+                            cid, count, unit, payload["dueDate"],
+                        ),
+                    })
                     continue
 
-                # 2) Si dueDate future mais arrivée à échéance -> remettre en To Do
-                #    (ce bloc est atteint quand due_dt <= now_utc; mais on l'a géré au-dessus)
+                # 2) Échéance atteinte -> remettre en To Do
                 if due_dt <= now_utc:
-                    # remettre en To Do en bas de liste
-                    payload = {"listId": str(todo_id), "position": end_position}
-                    client.patch_card(cid, payload)
-                    logging.info(
-                        "♻️ Retour en To Do (%s, R-%s%s) | position=%s",
-                        cid, count, unit, end_position
-                    )
+                    # remettre en To Do en bas de liste, en purgeant la dueDate
+                    # dans le même PATCH (un seul aller-retour HTTP)
+                    payload = {
+                        "listId": todo_id,
+                        "position": end_position,
+                        "dueDate": None,
+                    }
+                    pending_patches.append({
+                        "cid": cid,
+                        "payload": payload,
+                        "state_key": state_key,
+                        "sig": sig,
+                        "log": (
+                            "♻️ Retour en To Do (%s, R-%s%s) | position=%s",
+                            cid, count, unit, end_position,
+                        ),
+                    })
                     end_position += 1
-                    processed_in_this_state[cid] = state_key
                     continue
 
-                # 3) Sinon: dueDate > now -> on attend tranquillement
+                # 3) Sinon: dueDate > now -> on attend tranquillement.
+                #    Surtout NE PAS mémoriser l'état ici: (listId, dueDate) ne
+                #    changera pas quand l'échéance tombera, et la carte doit
+                #    alors passer dans la branche (2).
+                if next_wake is None or due_dt < next_wake:
+                    next_wake = due_dt
                 logging.debug(
                     "🕰️ En attente (%s): dueDate=%s > now=%s",
                     cid, due_dt.isoformat(), now_utc.isoformat()
                 )
-                processed_in_this_state[cid] = state_key
+
+            # Émission parallèle des PATCHes (bornée par pool_maxsize=4 de la
+            # session); l'état n'est mémorisé que pour les PATCHes réussis
+            if pending_patches:
+                with ThreadPoolExecutor(
+                    max_workers=min(4, len(pending_patches))
+                ) as pool:
+                    futures = {
+                        pool.submit(client.patch_card, p["cid"], p["payload"]): p
+                        for p in pending_patches
+                    }
+                    for fut in as_completed(futures):
+                        p = futures[fut]
+                        try:
+                            fut.result()
+                        except requests.HTTPError as e:
+                            logging.error(
+                                "HTTP error (patch %s): %s - %s",
+                                p["cid"], e, getattr(e.response, "text", ""),
+                            )
+                            continue
+                        patched = True
+                        logging.info(*p["log"])
+                        _remember(processed_in_this_state, p["cid"], p["state_key"])
+                        _remember(card_sigs, p["cid"], p["sig"])
+
+            # Purge des cartes disparues du board (supprimées/archivées)
+            seen_ids = {str(c.get("id")) for c in cards}
+            for state in (processed_in_this_state, card_sigs):
+                for gone in [k for k in state if k not in seen_ids]:
+                    del state[gone]
+
+            # Calcul du prochain sommeil: backoff si tick sans changement,
+            # mais réveil anticipé si une dueDate arrive avant.
+            if patched:
+                idle_ticks = 0
+            else:
+                # exposant borné: au-delà, le cap poll_seconds_max s'applique de
+                # toute façon et 2**idle_ticks deviendrait un big-int inutile
+                idle_ticks = min(idle_ticks + 1, 8)
+                sleep_for = min(poll_seconds * (2 ** idle_ticks), poll_seconds_max)
+            if next_wake is not None:
+                until_due = (next_wake - datetime.now(timezone.utc)).total_seconds()
+                sleep_for = min(sleep_for, max(1.0, until_due))
 
         except requests.HTTPError as e:
             logging.error("HTTP error: %s - %s", e, getattr(e.response, "text", ""))
         except Exception as e:
             logging.exception("Erreur inattendue: %s", e)
 
-        time.sleep(poll_seconds)
+        if events is not None:
+            # Bloque jusqu'au prochain webhook (ou timeout = poll de secours
+            # pour rattraper les dueDate expirées sans événement), puis draine
+            # les événements accumulés pour ne faire qu'une passe.
+            try:
+                events.get(timeout=sleep_for)
+                while not events.empty():
+                    events.get_nowait()
+            except queue.Empty:
+                pass
+        else:
+            time.sleep(sleep_for)
 
 
 if __name__ == "__main__":